@@ -1,11 +1,22 @@
 # Copyright (c) 2012-2014 The GPy authors (see AUTHORS.txt)
 # Licensed under the BSD 3-clause license (see LICENSE.txt)
 
+import math
 import numpy as np
-from ..util.univariate_Gaussian import std_norm_pdf, std_norm_cdf, derivLogCdfNormal, logCdfNormal
+from scipy.special import erfcx, ndtr
+from ..util.univariate_Gaussian import std_norm_pdf, std_norm_cdf
 from . import link_functions
 from .likelihood import Likelihood
 
+# plain Python floats, so that they do not upcast float32 arrays
+inv_sqrt_2pi = 1./math.sqrt(2*math.pi)
+sqrt_2_div_pi = math.sqrt(2./math.pi)
+sqrt1_2 = math.sqrt(0.5)
+log_1e_9 = math.log(1e-9)
+
+# link function tags, resolved once in Bernoulli.__init__
+_PROBIT, _HEAVISIDE, _OTHER_LINK = 0, 1, -1
+
 class Bernoulli(Likelihood):
     """
     Bernoulli likelihood
@@ -25,10 +36,24 @@ class Bernoulli(Likelihood):
             gp_link = link_functions.Probit()
 
         super(Bernoulli, self).__init__(gp_link, 'Bernoulli')
+        self._set_link_kind()
 
-        if isinstance(gp_link , (link_functions.Heaviside, link_functions.Probit)):
+    def _set_link_kind(self):
+        if isinstance(self.gp_link, link_functions.Probit):
+            self._link_kind = _PROBIT
+        elif isinstance(self.gp_link, link_functions.Heaviside):
+            self._link_kind = _HEAVISIDE
+        else:
+            self._link_kind = _OTHER_LINK
+
+        if self._link_kind != _OTHER_LINK:
             self.log_concave = True
 
+    def __setstate__(self, state):
+        super(Bernoulli, self).__setstate__(state)
+        # pickles written before _link_kind existed do not carry it
+        self._set_link_kind()
+
     def to_dict(self):
         """
         Convert the object into a json serializable dictionary.
@@ -49,12 +74,9 @@ class Bernoulli(Likelihood):
 
         ..Note:: Binary classification algorithm works better with classes {-1, 1}
         """
-        Y_prep = Y.copy()
-        Y1 = Y[Y.flatten()==1].size
-        Y2 = Y[Y.flatten()==0].size
-        assert Y1 + Y2 == Y.size, 'Bernoulli likelihood is meant to be used only with outputs in {0, 1}.'
-        Y_prep[Y.flatten() == 0] = -1
-        return Y_prep
+        assert np.all((Y == 0) | (Y == 1)), 'Bernoulli likelihood is meant to be used only with outputs in {0, 1}.'
+        # maps {0, 1} to {-1, 1} in a single pass
+        return (2*Y - 1).astype(Y.dtype, copy=False)
 
     def moments_match_ep(self, Y_i, tau_i, v_i, Y_metadata_i=None):
         """
@@ -63,36 +85,93 @@ class Bernoulli(Likelihood):
         :param i: number of observation (int)
         :param tau_i: precision of the cavity distribution (float)
         :param v_i: mean/variance of the cavity distribution (float)
+
+        .. Note::
+            This is the one-site version of moments_match_ep_vec, which should
+            be preferred whenever several sites are updated at once. It uses
+            plain float arithmetic, as numpy overheads dominate for one site.
         """
         if Y_i == 1:
             sign = 1.
         elif Y_i == 0 or Y_i == -1:
-            sign = -1
+            sign = -1.
         else:
             raise ValueError("bad value for Bernoulli observation (0, 1)")
-        if isinstance(self.gp_link, link_functions.Probit):
-            z = sign*v_i/np.sqrt(tau_i**2 + tau_i)
-            phi_div_Phi = derivLogCdfNormal(z)
-            log_Z_hat = logCdfNormal(z)
 
-            mu_hat = v_i/tau_i + sign*phi_div_Phi/np.sqrt(tau_i**2 + tau_i)
-            sigma2_hat = 1./tau_i - (phi_div_Phi/(tau_i**2+tau_i))*(z+phi_div_Phi)
+        if self._link_kind == _PROBIT:
+            scale = tau_i + 1.
+        elif self._link_kind == _HEAVISIDE:
+            scale = 1.
+        else:
+            #TODO: do we want to revert to numerical quadrature here?
+            raise ValueError("Exact moment matching not available for link {}".format(self.gp_link.__name__))
 
-        elif isinstance(self.gp_link, link_functions.Heaviside):
-            z = sign*v_i/np.sqrt(tau_i)
-            phi_div_Phi = derivLogCdfNormal(z)
-            log_Z_hat = logCdfNormal(z)
-            mu_hat = v_i/tau_i + sign*phi_div_Phi/np.sqrt(tau_i)
-            sigma2_hat = (1. - a*phi_div_Phi - np.square(phi_div_Phi))/tau_i
+        denom = math.sqrt(tau_i*scale)
+        z = sign*v_i/denom
+        if z < 0.:
+            # Phi(z) = exp(-z^2/2)*erfcx(-z/sqrt(2))/2, so that phi(z)/Phi(z) has no cancellation
+            e = erfcx(-z*sqrt1_2)
+            Z_hat = 0.5*math.exp(-0.5*z*z)*e
+            phi_div_Phi = sqrt_2_div_pi/e
+        else:
+            Z_hat = 0.5*math.erfc(-z*sqrt1_2)
+            phi_div_Phi = math.exp(-0.5*z*z)*inv_sqrt_2pi/Z_hat
+
+        mu_hat = v_i/tau_i + sign*phi_div_Phi/denom
+        sigma2_hat = (1. - phi_div_Phi*(z + phi_div_Phi)/scale)/tau_i
+        return Z_hat, mu_hat, sigma2_hat
+
+    def moments_match_ep_vec(self, Y, tau, v, Y_metadata=None):
+        """
+        Moments match of the marginal approximation in EP algorithm, for all
+        the sites at once.
+
+        :param Y: observations, in {0, 1} or {-1, 1} (array)
+        :param tau: precisions of the cavity distributions (array)
+        :param v: mean/variance of the cavity distributions (array)
+        :returns: Z_hat, mu_hat, sigma2_hat (1D arrays)
+
+        .. Note::
+            The three site vectors are read in lockstep, so callers should keep
+            them as parallel contiguous 1D arrays (as cavityParams does). Other
+            layouts are flattened into contiguous copies first.
+        """
+        Y, tau, v = (np.ascontiguousarray(a).ravel() for a in (Y, tau, v))
+        if np.any((Y != 1) & (Y != 0) & (Y != -1)):
+            raise ValueError("bad value for Bernoulli observation (0, 1)")
+        one = tau.dtype.type(1.)
+        sign = np.where(Y == 1, one, -one)
+
+        # z = sign*mu/sqrt(sigma2 + 1) for the probit link and sign*mu/sqrt(sigma2) for the
+        # Heaviside link, with mu = v/tau and sigma2 = 1/tau: i.e. sign*v/sqrt(tau*scale)
+        if self._link_kind == _PROBIT:
+            scale = tau + 1.
+        elif self._link_kind == _HEAVISIDE:
+            scale = one
         else:
             #TODO: do we want to revert to numerical quadrature here?
             raise ValueError("Exact moment matching not available for link {}".format(self.gp_link.__name__))
 
+        denom = np.sqrt(tau*scale)
+        z = sign*v/denom
+        Z_hat = ndtr(z)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            phi_div_Phi = np.exp(-0.5*z*z)*inv_sqrt_2pi/Z_hat
+        # Phi(z) underflows for z below about -sqrt(-2*log(tiny)), i.e. -37 in float64
+        # and -13 in float32: from 80% of that onwards use the identity
+        # phi(z)/Phi(z) = sqrt(2/pi)/erfcx(-z/sqrt(2)), which involves no cancellation
+        tail = z < -0.8*math.sqrt(-2.*math.log(np.finfo(z.dtype).tiny))
+        if np.any(tail):
+            phi_div_Phi[tail] = sqrt_2_div_pi/erfcx(-z[tail]*sqrt1_2)
+
+        mu_hat = v/tau + sign*phi_div_Phi/denom
+        sigma2_hat = (1. - phi_div_Phi*(z + phi_div_Phi)/scale)/tau
+
         # TODO: Output log_Z_hat instead of Z_hat (needs to be change in all others likelihoods)
-        return np.exp(log_Z_hat), mu_hat, sigma2_hat
+        return Z_hat, mu_hat, sigma2_hat
 
     def variational_expectations(self, Y, m, v, gh_points=None, Y_metadata=None):
-        if isinstance(self.gp_link, link_functions.Probit):
+        if self._link_kind == _PROBIT:
 
             if gh_points is None:
                 gh_x, gh_w = self._gh_points()
@@ -119,18 +198,18 @@ class Bernoulli(Likelihood):
 
     def predictive_mean(self, mu, variance, Y_metadata=None):
 
-        if isinstance(self.gp_link, link_functions.Probit):
-            return std_norm_cdf(mu/np.sqrt(1+variance))
+        if self._link_kind == _PROBIT:
+            return ndtr(mu/np.sqrt(1+variance))
 
-        elif isinstance(self.gp_link, link_functions.Heaviside):
-            return std_norm_cdf(mu/np.sqrt(variance))
+        elif self._link_kind == _HEAVISIDE:
+            return ndtr(mu/np.sqrt(variance))
 
         else:
             raise NotImplementedError
 
     def predictive_variance(self, mu, variance, pred_mean, Y_metadata=None):
 
-        if isinstance(self.gp_link, link_functions.Heaviside):
+        if self._link_kind == _HEAVISIDE:
             return 0.
         else:
             return np.nan
@@ -154,6 +233,7 @@ class Bernoulli(Likelihood):
             Each y_i must be in {0, 1}
         """
         #objective = (inv_link_f**y) * ((1.-inv_link_f)**(1.-y))
+        # the exact probability: going through logpdf_link would inherit its 1e-9 floor
         return np.where(y==1, inv_link_f, 1.-inv_link_f)
 
     def logpdf_link(self, inv_link_f, y, Y_metadata=None):
@@ -172,8 +252,15 @@ class Bernoulli(Likelihood):
         :rtype: float
         """
         #objective = y*np.log(inv_link_f) + (1.-y)*np.log(inv_link_f)
-        p = np.where(y==1, inv_link_f, 1.-inv_link_f)
-        return np.log(np.clip(p, 1e-9 ,np.inf))
+        if np.isscalar(inv_link_f) and np.isscalar(y):
+            # math is an order of magnitude cheaper than numpy on single values
+            if y == 1:
+                return math.log(inv_link_f) if inv_link_f > 1e-9 else log_1e_9
+            return math.log1p(-inv_link_f) if inv_link_f < 1.-1e-9 else log_1e_9
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logp = np.where(y==1, np.log(inv_link_f), np.log1p(-inv_link_f))
+        # fmax also floors the NaN given by a probability slightly below 0
+        return np.fmax(logp, log_1e_9)
 
     def dlogpdf_dlink(self, inv_link_f, y, Y_metadata=None):
         """
@@ -192,9 +279,18 @@ class Bernoulli(Likelihood):
         """
         #grad = (y/inv_link_f) - (1.-y)/(1-inv_link_f)
         #grad = np.where(y, 1./inv_link_f, -1./(1-inv_link_f))
-        ff = np.clip(inv_link_f, 1e-9, 1-1e-9)
-        denom = np.where(y==1, ff, -(1-ff))
-        return 1./denom
+        if np.isscalar(inv_link_f) and np.isscalar(y):
+            ff = min(max(inv_link_f, 0.), 1.)
+            if y == 1:
+                return 1./max(ff, 1e-9)
+            return -1./max(1. - ff, 1e-9)
+        # |f - (y != 1)| is f when y == 1 and 1-f otherwise, without a where() blend.
+        # The floor is applied to that probability rather than to f, as 1-1e-9
+        # rounds to 1 in float32, and the sign is applied afterwards in place
+        not_one = (y != 1)
+        p = np.maximum(np.abs(np.clip(inv_link_f, 0., 1.) - not_one), 1e-9)
+        grad = 1./p
+        return np.negative(grad, out=grad, where=not_one)
 
     def d2logpdf_dlink2(self, inv_link_f, y, Y_metadata=None):
         """
@@ -219,11 +315,12 @@ class Bernoulli(Likelihood):
         """
         #d2logpdf_dlink2 = -y/(inv_link_f**2) - (1-y)/((1-inv_link_f)**2)
         #d2logpdf_dlink2 = np.where(y, -1./np.square(inv_link_f), -1./np.square(1.-inv_link_f))
-        arg = np.where(y==1, inv_link_f, 1.-inv_link_f)
-        ret =  -1./np.square(np.clip(arg, 1e-9, 1e9))
-        if np.any(np.isinf(ret)):
-            stop
-        return ret
+        if np.isscalar(inv_link_f) and np.isscalar(y):
+            ff = min(max(inv_link_f, 0.), 1.)
+            p = max(ff if y == 1 else 1. - ff, 1e-9)
+            return -1./(p*p)
+        p = np.maximum(np.abs(np.clip(inv_link_f, 0., 1.) - (y != 1)), 1e-9)
+        return -1./np.square(p)
 
     def d3logpdf_dlink3(self, inv_link_f, y, Y_metadata=None):
         """
@@ -240,13 +337,22 @@ class Bernoulli(Likelihood):
         :returns: third derivative of log likelihood evaluated at points inverse_link(f)
         :rtype: Nx1 array
         """
-        assert np.atleast_1d(inv_link_f).shape == np.atleast_1d(y).shape
+        if np.isscalar(inv_link_f) and np.isscalar(y):
+            if y == 1:
+                return 2./(inv_link_f*inv_link_f*inv_link_f) if inv_link_f != 0. else math.inf
+            arg = 1. - inv_link_f
+            return -2./(arg*arg*arg) if arg != 0. else -math.inf
+        assert np.shape(inv_link_f) == np.shape(y)
         #d3logpdf_dlink3 = 2*(y/(inv_link_f**3) - (1-y)/((1-inv_link_f)**3))
-        state = np.seterr(divide='ignore')
-        # TODO check y \in {0, 1} or {-1, 1}
-        d3logpdf_dlink3 = np.where(y==1, 2./(inv_link_f**3), -2./((1.-inv_link_f)**3))
-        np.seterr(**state)
-        return d3logpdf_dlink3
+        # |f - (y != 1)| is f when y == 1 and 1-f otherwise. The sign is applied
+        # afterwards so that the singular base 1-f == 0 gives -inf, not +inf.
+        # The cube is spelled out as products since ** 3 goes through the much
+        # slower generic pow loop
+        not_one = (y != 1)
+        arg = np.abs(inv_link_f - not_one)
+        with np.errstate(divide='ignore'):
+            d3logpdf_dlink3 = 2./(arg*arg*arg)
+        return np.where(not_one, -d3logpdf_dlink3, d3logpdf_dlink3)
 
     def predictive_quantiles(self, mu, var, quantiles, Y_metadata=None):
         """
@@ -263,11 +369,9 @@ class Bernoulli(Likelihood):
 
         :param gp: latent variable
         """
-        orig_shape = gp.shape
-        gp = gp.flatten()
-        ns = np.ones_like(gp, dtype=int)
-        Ysim = np.random.binomial(ns, self.gp_link.transf(gp))
-        return Ysim.reshape(orig_shape)
+        # a Bernoulli(p) draw is a uniform draw falling below p
+        p = self.gp_link.transf(gp)
+        return np.asarray(np.random.random_sample(np.shape(p)) < p, dtype=int)
 
     def exact_inference_gradients(self, dL_dKdiag,Y_metadata=None):
         return np.zeros(self.size)
@@ -94,6 +94,68 @@ class TestObservationModels(unittest.TestCase):
         GPy.util.classification.conf_matrix(probs_mean_ep_alt, self.binary_Y)
         GPy.util.classification.conf_matrix(probs_mean_ep_nested, self.binary_Y)
 
+    @with_setup(setUp, tearDown)
+    def test_bernoulli_moments_match_ep_vec(self):
+        bernoulli = GPy.likelihoods.Bernoulli()
+        Y = self.binary_Y.flatten()
+        tau = np.random.rand(self.N) + 0.5
+        v = np.random.randn(self.N)
+
+        Z_hat, mu_hat, sigma2_hat = bernoulli.moments_match_ep_vec(Y, tau, v)
+        # compare against the moments computed by quadrature
+        for i in range(self.N):
+            Z_q, mu_q, sigma2_q = GPy.likelihoods.Likelihood.moments_match_ep(bernoulli, Y[i], tau[i], v[i])
+            self.assertAlmostEqual(Z_hat[i], Z_q, places=6)
+            self.assertAlmostEqual(mu_hat[i], mu_q, places=6)
+            self.assertAlmostEqual(sigma2_hat[i], sigma2_q, places=6)
+            Z_i, mu_i, sigma2_i = bernoulli.moments_match_ep(Y[i], tau[i], v[i])
+            self.assertAlmostEqual(Z_i, Z_hat[i], places=12)
+            self.assertAlmostEqual(mu_i, mu_hat[i], places=12)
+            self.assertAlmostEqual(sigma2_i, sigma2_hat[i], places=12)
+
+    @with_setup(setUp, tearDown)
+    def test_bernoulli_moments_match_ep_tail(self):
+        from GPy.util.univariate_Gaussian import derivLogCdfNormal
+        bernoulli = GPy.likelihoods.Bernoulli()
+        tau = 1.
+        denom = np.sqrt(tau**2 + tau)
+        for z in [-100., -300., -1000., -3000.]:
+            # negative observation: z = -v/denom
+            v = -z*denom
+            _, mu_hat, sigma2_hat = bernoulli.moments_match_ep_vec(np.array([0]), np.array([tau]), np.array([v]))
+            # robust reference values
+            phi_div_Phi = derivLogCdfNormal(z)
+            mu_ref = v/tau - phi_div_Phi/denom
+            sigma2_ref = 1./tau - (phi_div_Phi/(tau**2 + tau))*(z + phi_div_Phi)
+            self.assertTrue(abs(mu_hat[0] - mu_ref) < 1e-8*abs(mu_ref))
+            self.assertTrue(abs(sigma2_hat[0] - sigma2_ref) < 1e-6*sigma2_ref)
+            Z_i, mu_i, sigma2_i = bernoulli.moments_match_ep(0, tau, v)
+            self.assertTrue(abs(mu_i - mu_ref) < 1e-8*abs(mu_ref))
+            self.assertTrue(abs(sigma2_i - sigma2_ref) < 1e-6*sigma2_ref)
+
+        # very strong disagreement between cavity and observation must keep a positive variance
+        _, _, sigma2_hat = bernoulli.moments_match_ep(0, 0.5, 1e4)
+        self.assertAlmostEqual(sigma2_hat, 2./3., places=6)
+
+    @with_setup(setUp, tearDown)
+    def test_bernoulli_moments_match_ep_vec_float32(self):
+        bernoulli = GPy.likelihoods.Bernoulli()
+        z = np.array([-29., -20., -14., -10.6, -10., -5., -1., 0., 2., 5., 20.])
+        Y = np.zeros(z.size, dtype=int)
+        tau = np.ones(z.size)
+        # negative observations: z = -v/sqrt(tau**2 + tau)
+        v = -z*np.sqrt(2.)
+        res32 = bernoulli.moments_match_ep_vec(Y, tau.astype(np.float32), v.astype(np.float32))
+        res64 = bernoulli.moments_match_ep_vec(Y, tau, v)
+        for r32, r64 in zip(res32, res64):
+            self.assertEqual(r32.dtype, np.float32)
+            self.assertTrue(np.all(np.isfinite(r32)))
+        Z_32, mu_32, sigma2_32 = res32
+        Z_64, mu_64, sigma2_64 = res64
+        np.testing.assert_allclose(Z_32, Z_64, rtol=1e-5, atol=1e-38)
+        np.testing.assert_allclose(mu_32, mu_64, rtol=1e-5)
+        np.testing.assert_allclose(sigma2_32, sigma2_64, rtol=1e-4)
+
     @nottest
     def rmse(self, Y, Ystar):
         return np.sqrt(np.mean((Y - Ystar) ** 2))
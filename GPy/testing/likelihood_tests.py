@@ -732,6 +732,76 @@ class TestNoiseModels(object):
         print(model)
         assert grad.checkgrad(verbose=1)
 
+class BernoulliTests(unittest.TestCase):
+    """
+    Bernoulli specific tests, at the boundaries of the inverse link
+    """
+
+    def setUp(self):
+        self.lik = GPy.likelihoods.Bernoulli()
+        self.fs = [0., 1e-12, 0.3, 0.7, 1.-1e-12, 1.]
+        self.ys = [1, 0, -1]
+
+    def test_d3logpdf_dlink3_closed_form(self):
+        for f in self.fs:
+            for y in self.ys:
+                if y == 1:
+                    expected = 2./f**3 if f != 0. else np.inf
+                else:
+                    expected = -2./(1.-f)**3 if f != 1. else -np.inf
+                d3 = self.lik.d3logpdf_dlink3(np.array([[f]]), np.array([[y]]))[0, 0]
+                np.testing.assert_allclose(d3, expected, rtol=1e-12)
+
+    def test_pdf_link_edges(self):
+        fs = np.array(self.fs)[:, None]
+        p1 = self.lik.pdf_link(fs, np.ones_like(fs))
+        for y in [0, -1]:
+            p0 = self.lik.pdf_link(fs, np.full(fs.shape, y))
+            np.testing.assert_array_equal(p0 + p1, 1.)
+        self.assertEqual(self.lik.pdf_link(np.array([[0.]]), np.array([[1]]))[0, 0], 0.)
+        self.assertEqual(self.lik.pdf_link(np.array([[1.]]), np.array([[0]]))[0, 0], 0.)
+        # probabilities slightly outside [0, 1] are floored, not NaN
+        for f, y in [(-1e-12, 1), (1.+1e-12, 0), (1.+1e-12, -1)]:
+            logp = self.lik.logpdf_link(np.array([[f]]), np.array([[y]]))[0, 0]
+            self.assertEqual(logp, np.log(1e-9))
+            self.assertEqual(self.lik.logpdf_link(f, y), logp)
+
+    def test_scalar_matches_array(self):
+        for func in [self.lik.logpdf_link, self.lik.dlogpdf_dlink, self.lik.d2logpdf_dlink2, self.lik.d3logpdf_dlink3]:
+            for f in self.fs:
+                for y in self.ys:
+                    scalar = func(f, y)
+                    array = func(np.array([[f]]), np.array([[y]]))[0, 0]
+                    np.testing.assert_allclose(scalar, array, rtol=1e-12,
+                                               err_msg="{} at f={}, y={}".format(func.__name__, f, y))
+
+    def test_float32_matches_float64(self):
+        for func in [self.lik.logpdf_link, self.lik.dlogpdf_dlink, self.lik.d2logpdf_dlink2]:
+            for y in self.ys:
+                y_arr = np.full((len(self.fs), 1), y)
+                f64 = np.array(self.fs)[:, None]
+                r32 = func(f64.astype(np.float32), y_arr)
+                r64 = func(f64, y_arr)
+                self.assertEqual(r32.dtype, np.float32)
+                self.assertTrue(np.all(np.isfinite(r32)))
+                np.testing.assert_allclose(r32, r64, rtol=1e-6, atol=1e-6,
+                                           err_msg="{} at y={}".format(func.__name__, y))
+
+    def test_unpickle_without_link_kind(self):
+        import pickle
+        for lik in [self.lik, GPy.likelihoods.Bernoulli(link_functions.Heaviside())]:
+            state = lik.__getstate__()
+            # emulate a pickle written before _link_kind was introduced
+            del state['_link_kind']
+            old = GPy.likelihoods.Bernoulli.__new__(GPy.likelihoods.Bernoulli)
+            old.__setstate__(state)
+            restored = pickle.loads(pickle.dumps(old))
+            self.assertEqual(restored._link_kind, lik._link_kind)
+            self.assertTrue(restored.log_concave)
+            mu, var = np.array([[0.3]]), np.array([[0.5]])
+            np.testing.assert_allclose(restored.predictive_mean(mu, var), lik.predictive_mean(mu, var))
+            np.testing.assert_allclose(restored.moments_match_ep(1, 0.7, 0.2), lik.moments_match_ep(1, 0.7, 0.2))
+
 class LaplaceTests(unittest.TestCase):
     """
     Specific likelihood tests, not general enough for the above tests